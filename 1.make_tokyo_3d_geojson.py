@@ -2,27 +2,37 @@
 # -*- coding: utf-8 -*-
 
 """
-新宿駅 屋内地図R2（Shapefile群）→ フロアごとにZを付与した3D GeoJSONを一括生成。
+新宿駅 屋内地図R2（Shapefile群）→ フロアごとにZを付与した3Dデータを一括生成。
 - ./shape 配下の .shp を全て処理
 - WGS84(EPSG:4326) へ再投影（入力にCRSがある場合）
 - ファイル名からフロアを推定し、BASE_Z + FLOOR_OFFSETS[階] で絶対Zを付与
-- 出力は ./geojson に *.3d.geojson
-- 空/NULL/無効ジオメトリは安全にスキップ（必要なら make_valid で救済）
+- 出力は ./geojson に *.3d.fgb（OUT_DRIVER で GPKG / GeoJSON も選択可）
+- 空/NULL/無効ジオメトリは安全にスキップ（無効なものは make_valid で救済）
 """
 
-import json, re, sys
+import importlib.util, json, os, re, sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 import geopandas as gpd
-from shapely.geometry import (
-    Point, LineString, Polygon, MultiPoint, MultiLineString,
-    MultiPolygon, GeometryCollection, mapping
-)
+import numpy as np
+import shapely
+from pyproj import CRS, Transformer
 
-# shapely>=2 があれば無効ジオメトリ救済を有効化
+# pyogrio があれば GeoDataFrame を GDAL で直接読み書きする（なければ read_file / to_file にフォールバック）
 try:
-    from shapely.validation import make_valid  # type: ignore
+    import pyogrio  # type: ignore
 except Exception:
-    make_valid = None
+    pyogrio = None
+
+# orjson があれば GeoJSON 出力時の properties 書き出しを C 実装で高速化（なければ標準 json）
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None
+
+# pyarrow があれば pyogrio の読込を Arrow 経由にする（属性を列単位でまとめて変換）
+USE_ARROW = importlib.util.find_spec("pyarrow") is not None
 
 # ====== 設定（必要に応じて変更） =========================================
 BASE_Z = 3.2  # 新宿駅の基準標高 (m, AMSL)
@@ -44,90 +54,189 @@ FLOOR_OFFSETS = {
 # 入出力ディレクトリ
 INPUT_DIR  = Path("./shape")
 OUTPUT_DIR = Path("./geojson")
+
+# 出力形式:
+#   'FlatGeobuf' → *.3d.fgb（既定。書き込み・読み込みとも高速。タイプ混在のレイヤだけ *.3d.gpkg）
+#   'GPKG'       → *.3d.gpkg（レイヤ名はフロアラベル）
+#   'GeoJSON'    → *.3d.geojson（Web公開用に直接使いたい場合のみ）
+OUT_DRIVER = "FlatGeobuf"
+OUT_SUFFIXES = {"FlatGeobuf": ".fgb", "GPKG": ".gpkg", "GeoJSON": ".geojson"}
+
+# 読み込む属性列（None なら全列）。出力に不要な列を読まないことで読込を軽くできる
+#   例: READ_COLUMNS = ["id", "category", "name"]
+READ_COLUMNS = None
+
+# 種類ごとに出力へ残す属性列（ファイル名末尾の種類 → 列名リスト）。載っていない種類は READ_COLUMNS に従う
+# 指定した列だけを読み込むので、大きな日本語テキスト列などを読まず・書かずに済む
+#   例: KEEP_PROPS = {"Space": ["id", "category", "name"], "Drawing": ["id"]}
+KEEP_PROPS = {}
+
+# 数値列を値が変わらない範囲で int32 / float32 に縮めて書き出す（出力サイズの削減）
+DOWNCAST_NUMERIC = True
+
+# .cpg が無い DBF の文字コード（.cpg が無いと GDAL は ISO-8859-1 とみなし、日本語が文字化けする）
+# .cpg がある Shapefile（CP932 など）はその指定を優先し、ここでは上書きしない
+SHP_ENCODING = "utf-8"
+
+# 並列プロセス数（1 にすると従来どおり逐次処理）
+MAX_WORKERS = os.cpu_count() or 1
 # ======================================================================
 
-# 代表的なファイル名パターン（ShinjukuTerminal_X_*）
-PATTERNS = [
-    (re.compile(r"_b3[_\.]", re.I), "B3"),
-    (re.compile(r"_b2[_\.]", re.I), "B2"),
-    (re.compile(r"_b1[_\.]", re.I), "B1"),
-    (re.compile(r"_0[_\.]",  re.I), "0F"),
-    (re.compile(r"_1[_\.]",  re.I), "1F"),
-    (re.compile(r"_2out[_\.]", re.I), "2out"),
-    (re.compile(r"_3out[_\.]", re.I), "3out"),
-    (re.compile(r"_4out[_\.]", re.I), "4out"),
-    (re.compile(r"_2[_\.]",  re.I), "2F"),
-    (re.compile(r"_3[_\.]",  re.I), "3F"),
-    (re.compile(r"_4[_\.]",  re.I), "4F"),
+# 代表的なファイル名タグ（ShinjukuTerminal_X_* の X → フロアラベル）
+FLOOR_TAGS = [
+    ("b3", "B3"), ("b2", "B2"), ("b1", "B1"),
+    ("0", "0F"), ("1", "1F"),
+    ("2out", "2out"), ("3out", "3out"), ("4out", "4out"),
+    ("2", "2F"), ("3", "3F"), ("4", "4F"),
 ]
 
+# 全タグを1本の正規表現にまとめ、一致した名前付きグループからラベルを引く
+_FLOOR_RE = re.compile(
+    "_(?:" + "|".join(f"(?P<g{i}>{re.escape(tag)})" for i, (tag, _) in enumerate(FLOOR_TAGS)) + r")[_\.]",
+    re.I,
+)
+_GROUP_TO_LABEL = {f"g{i}": label for i, (_, label) in enumerate(FLOOR_TAGS)}
+
 def infer_floor_label(filename: str) -> str:
     """ファイル名からフロアラベルを推定（デフォルト0F）"""
-    for pat, label in PATTERNS:
-        if pat.search(filename):
-            return label
-    return "0F"
-
-def add_z_to_geom(geom, z: float):
-    """2D/3D Geometry → 3D（全頂点に同一Zで上書き）"""
-    if geom is None or getattr(geom, "is_empty", False):
-        return geom
-    gt = geom.geom_type
-
-    if gt == "Point":
-        return Point(geom.x, geom.y, z)
-
-    if gt == "MultiPoint":
-        return MultiPoint([Point(p.x, p.y, z) for p in geom.geoms])
-
-    if gt == "LineString":
-        # 既存にZがあっても z で上書き
-        return LineString([(xy[0], xy[1], z) for xy in list(geom.coords)])
-
-    if gt == "MultiLineString":
-        return MultiLineString([
-            LineString([(xy[0], xy[1], z) for xy in list(ls.coords)]) for ls in geom.geoms
-        ])
-
-    if gt == "Polygon":
-        ext = [(xy[0], xy[1], z) for xy in list(geom.exterior.coords)]
-        ints = [[(xy[0], xy[1], z) for xy in list(r.coords)] for r in geom.interiors]
-        return Polygon(ext, ints)
-
-    if gt == "MultiPolygon":
-        polys = []
-        for p in geom.geoms:
-            ext = [(xy[0], xy[1], z) for xy in list(p.exterior.coords)]
-            ints = [[(xy[0], xy[1], z) for xy in list(r.coords)] for r in p.interiors]
-            polys.append(Polygon(ext, ints))
-        return MultiPolygon(polys)
-
-    if gt == "GeometryCollection":
-        return GeometryCollection([add_z_to_geom(g, z) for g in geom.geoms])
-
-    # 想定外タイプは素通し
-    return geom
+    m = _FLOOR_RE.search(filename)
+    return _GROUP_TO_LABEL[m.lastgroup] if m else "0F"
+
+# 種類はファイル名末尾の "_種類.shp" から拾う（2.merge_tokyo_floor_geojson.py の infer_kind と同じ考え方）
+_KIND_RE = re.compile(r"_([A-Za-z0-9]+)\.shp$", re.I)
+_KEEP_BY_LOWER = {k.lower(): v for k, v in KEEP_PROPS.items()}
+
+def infer_kind(filename: str) -> str:
+    """ファイル名から種類（Space / Floor / …）を推定"""
+    m = _KIND_RE.search(filename)
+    return m.group(1) if m else "Unknown"
+
+def downcast_numeric(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """数値列を int32 / float32 に縮める（値が変わってしまう列はそのまま）"""
+    i32 = np.iinfo(np.int32)
+    for col in gdf.columns:
+        if col == gdf.geometry.name:
+            continue
+        s = gdf[col]
+        if not isinstance(s.dtype, np.dtype) or s.dtype.itemsize <= 4 or s.empty:
+            continue
+        if s.dtype.kind in "iu" and i32.min <= s.min() and s.max() <= i32.max:
+            gdf[col] = s.astype(np.int32)
+        elif s.dtype.kind == "f":
+            f = s.astype(np.float32)
+            if ((f.astype(s.dtype) == s) | s.isna()).all():
+                gdf[col] = f
+    return gdf
 
-def clean_geoms(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    """NULL/空/無効ジオメトリを除去し、可能なら make_valid で救済"""
-    if gdf is None or gdf.empty:
-        return gdf
+WGS84 = CRS.from_epsg(4326)
 
-    # NULL を除去
-    gdf = gdf[~gdf.geometry.isna()].copy()
+@lru_cache(maxsize=32)
+def _transformer_to_wgs84(src_wkt: str) -> Transformer:
+    """入力CRSごとに1度だけ Transformer を作って使い回す（プロセスごとにキャッシュ）"""
+    return Transformer.from_crs(CRS.from_wkt(src_wkt), WGS84, always_xy=True)
 
-    # 空を除去
-    if hasattr(gdf.geometry, "is_empty"):
-        gdf = gdf[~gdf.geometry.is_empty].copy()
+def to_wgs84(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    WGS84(EPSG:4326) へ再投影。既に WGS84 / CRS 無しなら何もしない。
+    to_crs の代わりに座標配列をまとめて変換して書き戻す
+    """
+    if not gdf.crs or gdf.crs == WGS84:
+        return gdf
+    t = _transformer_to_wgs84(gdf.crs.to_wkt())
+    geoms = np.array(gdf.geometry.values, dtype=object)
+    xyz = shapely.get_coordinates(geoms, include_z=True)
+    # inplace 変換は連続配列でないと効かないので、x / y を行ごとに連続した (2, N) にしてから変換
+    xy = np.ascontiguousarray(xyz[:, :2].T)
+    t.transform(xy[0], xy[1], inplace=True)
+    xyz[:, 0], xyz[:, 1] = xy
+    return gdf.set_geometry(shapely.set_coordinates(geoms, xyz), crs=WGS84)
+
+def set_z(geoms, z: float):
+    """ジオメトリ配列の全頂点に同一Zを設定（2D→3D化、既存Zも z で上書き）"""
+    # 2D のものは force_3d だけで全頂点が Z=z になる
+    had_z = shapely.has_z(geoms)
+    geoms = shapely.force_3d(geoms, z)
+    if had_z.any():
+        # 元から Z を持つものだけ座標を取り出して上書き
+        sub = geoms[had_z]
+        coords = shapely.get_coordinates(sub, include_z=True)
+        coords[:, 2] = z
+        geoms[had_z] = shapely.set_coordinates(sub, coords)
+    return geoms
 
-    # 可能なら救済 → 再度 空を除去
-    if make_valid is not None and not gdf.empty:
-        gdf["geometry"] = gdf["geometry"].map(make_valid)
-        if hasattr(gdf.geometry, "is_empty"):
-            gdf = gdf[~gdf.geometry.is_empty].copy()
+def clean_geoms(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """NULL/空/無効ジオメトリを除去し、make_valid で救済"""
+    if gdf is None or gdf.empty:
+        return gdf
 
+    # 配列のまま一括で救済（NULL は None のまま返る）
+    geoms = shapely.make_valid(gdf.geometry.values)
+
+    # NULL / 空（救済の結果空になったものも含む）を1回のマスクでまとめて除去
+    keep = ~(shapely.is_missing(geoms) | shapely.is_empty(geoms))
+    return gdf.loc[keep].set_geometry(geoms[keep], crs=gdf.crs)
+
+def read_gdf(path: Path, columns=None) -> gpd.GeoDataFrame:
+    """Shapefile を読み込む（columns 指定時はその属性列だけ。存在しない列は無視）"""
+    # 文字コードは .cpg が無いときだけ指定する
+    enc = {} if path.with_suffix(".cpg").exists() else {"encoding": SHP_ENCODING}
+    if pyogrio is not None:
+        return pyogrio.read_dataframe(path, columns=columns, use_arrow=USE_ARROW, **enc)
+    gdf = gpd.read_file(path, **enc)
+    if columns is not None:
+        gdf = gdf[[c for c in columns if c in gdf.columns] + [gdf.geometry.name]]
     return gdf
 
+def dump_json(obj) -> bytes:
+    """UTF-8 の JSON バイト列に変換（日付などは文字列化）"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8")
+
+def write_geojson(gdf: gpd.GeoDataFrame, path: Path):
+    """ジオメトリは shapely.to_geojson でまとめて文字列化し、FeatureCollection に組み立てて書き出す"""
+    geoms = shapely.to_geojson(gdf.geometry.values)
+    # 欠損値は null で書く（属性列が無いと to_dict は [] を返すので空 properties で埋める）
+    attrs = gdf.drop(columns=gdf.geometry.name)
+    props = attrs.astype(object).where(attrs.notna(), None).to_dict("records") or [{}] * len(gdf)
+    with path.open("wb") as f:
+        f.write(b'{"type":"FeatureCollection","features":[')
+        for i, (g, p) in enumerate(zip(geoms, props)):
+            if i:
+                f.write(b",")
+            f.write(b'{"type":"Feature","properties":' + dump_json(p)
+                    + b',"geometry":' + (g.encode("utf-8") if g is not None else b"null") + b"}")
+        f.write(b"]}")
+
+def pick_driver(geoms) -> str:
+    """
+    書き出しドライバを決める（基本は OUT_DRIVER）。
+    FlatGeobuf は Polygon / MultiPolygon などの混在レイヤを Unknown（2D）型でしか書けず Z が落ちるので、
+    混在している場合だけ GPKG に切り替える（Multi への昇格はしない）
+    """
+    if OUT_DRIVER == "FlatGeobuf" and len(np.unique(shapely.get_type_id(geoms))) > 1:
+        return "GPKG"
+    return OUT_DRIVER
+
+def write_gdf(gdf: gpd.GeoDataFrame, path: Path, driver: str, layer: str | None = None):
+    """GeoDataFrame を driver で一括書き出し（行ごとの dict 化はしない）"""
+    if driver == "GeoJSON":
+        write_geojson(gdf, path)
+        return
+    # GPKG 以外はレイヤ名を持たないので渡さない
+    if driver != "GPKG":
+        layer = None
+    opts = {}
+    if driver == "FlatGeobuf":
+        # 中間ファイルなので空間インデックスは作らず、地物の順序を元データのまま保つ
+        opts["SPATIAL_INDEX"] = "NO"
+    # Polygon / MultiPolygon はそのままの型で書く（勝手に Multi へ昇格させない）
+    if pyogrio is not None:
+        pyogrio.write_dataframe(gdf, path, layer=layer, driver=driver, promote_to_multi=False,
+                                layer_options=opts)
+    else:
+        gdf.to_file(path, layer=layer, driver=driver, promote_to_multi=False, **opts)
+
 def process_shp(shp: Path):
     label = infer_floor_label(shp.name)
     if label not in FLOOR_OFFSETS:
@@ -135,8 +244,9 @@ def process_shp(shp: Path):
         label = "0F"
     z_abs = BASE_Z + FLOOR_OFFSETS[label]
 
-    # 1) 読み込み
-    gdf = gpd.read_file(shp)
+    # 1) 読み込み（KEEP_PROPS に種類があればその列だけ）
+    keep = _KEEP_BY_LOWER.get(infer_kind(shp.name).lower())
+    gdf = read_gdf(shp, columns=keep if keep is not None else READ_COLUMNS)
 
     # 2) ジオメトリクレンジング
     gdf = clean_geoms(gdf)
@@ -147,53 +257,43 @@ def process_shp(shp: Path):
     # 3) CRS がある場合のみ再投影（なければそのまま）
     if gdf.crs:
         try:
-            gdf = gdf.to_crs(epsg=4326)
+            gdf = to_wgs84(gdf)
         except Exception as e:
             print(f"[WARN] {shp.name}: CRS変換に失敗しました（素通し）: {e}")
 
-    # 4) Z 付与
-    gdf3d = gdf.copy()
-    gdf3d["geometry"] = gdf3d["geometry"].apply(lambda g: add_z_to_geom(g, z_abs))
-    gdf3d["__floor"] = label
-    gdf3d["__z_abs"] = float(z_abs)
+    if DOWNCAST_NUMERIC:
+        gdf = downcast_numeric(gdf)
 
-    # 念のため最終チェック（Z付与後に空/Noneがあれば落とす）
-    gdf3d = gdf3d[~gdf3d.geometry.isna()].copy()
-    if hasattr(gdf3d.geometry, "is_empty"):
-        gdf3d = gdf3d[~gdf3d.geometry.is_empty].copy()
+    # 4) Z 付与（gdf はここまでで作り直した自前のフレームなので、コピーせず直接書き換える）
+    gdf["geometry"] = set_z(gdf.geometry.values, z_abs)
+    gdf["__floor"] = label
+    gdf["__z_abs"] = float(z_abs)
+
+    # 念のため最終チェック（Z付与後に空/Noneがあれば落とす）。マスクは1回で作り、必要なときだけ絞り込む
+    geoms = gdf.geometry.values
+    valid = ~(shapely.is_missing(geoms) | shapely.is_empty(geoms))
+    gdf3d = gdf if valid.all() else gdf.loc[valid]
     if gdf3d.empty:
         print(f"[SKIP] {shp.name}: Z付与後に有効なジオメトリなし")
         return
 
-    # 5) GeoJSON 出力
-    outname = shp.with_suffix("").name + ".3d.geojson"
+    # 5) 出力（FlatGeobuf / GPKG / GeoJSON）
+    driver = pick_driver(gdf3d.geometry.values)
+    outname = shp.with_suffix("").name + ".3d" + OUT_SUFFIXES[driver]
     outpath = OUTPUT_DIR / outname
     outpath.parent.mkdir(parents=True, exist_ok=True)
 
-    fc = {"type": "FeatureCollection", "features": []}
-    for idx, row in gdf3d.iterrows():
-        geom = row.geometry
-        if geom is None or getattr(geom, "is_empty", False):
-            print(f"[SKIP] {shp.name} idx={idx}: 空ジオメトリ")
-            continue
-        try:
-            fc["features"].append({
-                "type": "Feature",
-                "geometry": mapping(geom),  # ここで __geo_interface__ を持たないと失敗する
-                "properties": {k: v for k, v in row.items() if k != "geometry"}
-            })
-        except Exception as e:
-            print(f"[SKIP] {shp.name} idx={idx}: mapping失敗: {e}")
-
-    if not fc["features"]:
-        print(f"[SKIP] {shp.name}: 出力対象なし")
-        return
-
-    with outpath.open("w", encoding="utf-8") as f:
-        json.dump(fc, f, ensure_ascii=False)
+    write_gdf(gdf3d, outpath, driver, layer=label)
 
     print(f"[OK] {shp.name} -> {outpath.name}  floor={label} z={z_abs:.2f}")
 
+def process_shp_safe(shp: Path):
+    """1ファイル分の失敗で全体が止まらないよう、例外はログに出して握りつぶす"""
+    try:
+        process_shp(shp)
+    except Exception as e:
+        print(f"[ERR] {shp}: {e}")
+
 def main():
     shps = list(INPUT_DIR.rglob("*.shp"))
     if not shps:
@@ -203,13 +303,18 @@ def main():
     # floors 表示は順序を固定して見やすくする
     floors_str = ", ".join([f"{k}:{v}" for k, v in FLOOR_OFFSETS.items()])
     print(f"[INFO] BASE_Z={BASE_Z}, floors={{ {floors_str} }}")
+    if OUT_DRIVER not in OUT_SUFFIXES:
+        print(f"[ERR] OUT_DRIVER '{OUT_DRIVER}' は不正です")
+        sys.exit(2)
     print(f"[INFO] 対象SHP数: {len(shps)}")
 
-    for shp in sorted(shps):
-        try:
-            process_shp(shp)
-        except Exception as e:
-            print(f"[ERR] {shp}: {e}")
+    # ファイルごとに独立（読込→再投影→Z付与→書出し）なのでプロセス並列で処理
+    if MAX_WORKERS <= 1:
+        for shp in sorted(shps):
+            process_shp_safe(shp)
+    else:
+        with ProcessPoolExecutor(max_workers=MAX_WORKERS) as ex:
+            list(ex.map(process_shp_safe, sorted(shps)))
 
 if __name__ == "__main__":
     main()
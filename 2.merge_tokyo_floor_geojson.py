@@ -2,9 +2,9 @@
 # -*- coding: utf-8 -*-
 
 """
-同じフロアの 3D GeoJSON（*.3d.geojson）をマージする簡易スクリプト。
+同じフロアの 3D データ（*.3d.fgb / *.3d.gpkg / *.3d.geojson）をマージする簡易スクリプト。
 
-- INPUT_DIR 配下の *.3d.geojson を走査（再帰）
+- INPUT_DIR 配下の *.3d.fgb / *.3d.gpkg / *.3d.geojson を走査（再帰）
 - ファイル名からフロアを推定（B3/B2/B1/0/1/2/3/4, 2out/3out/4out）
 - モード:
     'per_floor'            → フロアごとに1ファイル
@@ -17,12 +17,42 @@
   geojson_merged/Shinjuku_B2.points.geojson                    （per_floor_by_geom）
 """
 
-import json, re, sys, gzip
+import json, os, re, shutil, subprocess, sys, gzip, warnings
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+# ijson があれば GeoJSON を丸ごと読まずに Feature 単位でストリーム処理
+try:
+    import ijson  # type: ignore
+except Exception:
+    ijson = None
+
+# orjson があれば JSON の読み書きを C 実装で高速化（なければ標準 json）
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None
+
+# mgzip があれば gzip 圧縮をマルチスレッドで行う（pigz コマンドがあればそちらを優先）
+try:
+    import mgzip  # type: ignore
+except Exception:
+    mgzip = None
+
+# pyarrow があれば Feature を dict にせず、Arrow テーブル（列指向）のまま読んで書く
+try:
+    import numpy as np
+    import pyarrow as pa  # type: ignore
+    import pyarrow.compute as pc  # type: ignore
+    import pyogrio
+    import shapely
+except Exception:
+    pa = None
 
 # ====== ここだけ触ればOK ===========================================
-INPUT_DIR  = Path("./geojson")        # 元の *.3d.geojson 置き場
+INPUT_DIR  = Path("./geojson")        # 元の *.3d.fgb / *.3d.geojson 置き場
 OUTPUT_DIR = Path("./geojson_merged") # 出力先
 
 # どの種類のファイルを対象にするか（名前に含まれるサフィックスで判定）
@@ -39,36 +69,51 @@ MERGE_MODE = 'per_floor_by_geom'  # ← 推奨
 
 # 出力を gzip したい場合は True（拡張子は .geojson.gz）
 GZIP_OUTPUT = False
+# gzip 圧縮のスレッド数（pigz / mgzip がある場合のみ有効。出力は通常の gzip 形式）
+GZIP_THREADS = os.cpu_count() or 1
+
+# 入力ファイルを並列に読むスレッド数（1 にすると逐次）。同時にメモリへ載せるファイル数もこの数まで
+READ_WORKERS = os.cpu_count() or 1
 # ====================================================================
 
-# フロア推定用パターン（ファイル名に含まれるタグ）
-PATTERNS = [
-    (re.compile(r"_b3[_\.]", re.I), "B3"),
-    (re.compile(r"_b2[_\.]", re.I), "B2"),
-    (re.compile(r"_b1[_\.]", re.I), "B1"),
-    (re.compile(r"_0[_\.]",  re.I), "0F"),
-    (re.compile(r"_1[_\.]",  re.I), "1F"),
-    (re.compile(r"_2out[_\.]", re.I), "2out"),
-    (re.compile(r"_3out[_\.]", re.I), "3out"),
-    (re.compile(r"_4out[_\.]", re.I), "4out"),
-    (re.compile(r"_2[_\.]",  re.I), "2F"),
-    (re.compile(r"_3[_\.]",  re.I), "3F"),
-    (re.compile(r"_4[_\.]",  re.I), "4F"),
+# 入力として扱う拡張子（1.make_tokyo_3d_geojson.py の OUT_DRIVER に対応）
+INPUT_SUFFIXES = (".3d.fgb", ".3d.gpkg", ".3d.geojson")
+
+# フロア推定用タグ（ファイル名に含まれる "_タグ_" / "_タグ." → ラベル）
+FLOOR_TAGS = [
+    ("b3", "B3"), ("b2", "B2"), ("b1", "B1"),
+    ("0", "0F"), ("1", "1F"),
+    ("2out", "2out"), ("3out", "3out"), ("4out", "4out"),
+    ("2", "2F"), ("3", "3F"), ("4", "4F"),
 ]
 
+# 全タグを1本の正規表現にまとめ、一致した名前付きグループからラベルを引く
+_FLOOR_RE = re.compile(
+    "_(?:" + "|".join(f"(?P<g{i}>{re.escape(tag)})" for i, (tag, _) in enumerate(FLOOR_TAGS)) + r")[_\.]",
+    re.I,
+)
+_GROUP_TO_LABEL = {f"g{i}": label for i, (_, label) in enumerate(FLOOR_TAGS)}
+
+@lru_cache(maxsize=4096)
 def infer_floor_label(filename: str) -> str:
-    for pat, label in PATTERNS:
-        if pat.search(filename):
-            return label
-    return "0F"  # 不明なら 0F に寄せる
+    m = _FLOOR_RE.search(filename)
+    return _GROUP_TO_LABEL[m.lastgroup] if m else "0F"  # 不明なら 0F に寄せる
 
+# 種類の判定も INCLUDE_KINDS を1本の正規表現にまとめておく
+_KIND_RE = re.compile(
+    "_(" + "|".join(re.escape(k) for k in INCLUDE_KINDS) + r")\.3d\.(?:fgb|gpkg|geojson)$", re.I
+)
+_KIND_BY_LOWER = {k.lower(): k for k in INCLUDE_KINDS}
+_ANY_KIND_RE = re.compile(r"_([A-Za-z0-9]+)\.3d\.(?:fgb|gpkg|geojson)$")
+
+@lru_cache(maxsize=4096)
 def infer_kind(filename: str) -> str:
-    # 例: ..._Space.3d.geojson → Space を拾う
-    for k in INCLUDE_KINDS:
-        if re.search(rf"_{re.escape(k)}\.3d\.geojson$", filename, re.I):
-            return k
+    # 例: ..._Space.3d.fgb / ..._Space.3d.geojson → Space を拾う
+    m = _KIND_RE.search(filename)
+    if m:
+        return _KIND_BY_LOWER[m.group(1).lower()]
     # 見つからない場合は末尾の直前パートを拾っておく（保険）
-    m = re.search(r"_([A-Za-z0-9]+)\.3d\.geojson$", filename)
+    m = _ANY_KIND_RE.search(filename)
     return m.group(1) if m else "Unknown"
 
 def categorize_geom(ft) -> str:
@@ -96,34 +141,273 @@ def categorize_geom(ft) -> str:
         return "polygons"
     return "others"
 
-def load_features(path: Path):
-    with path.open("r", encoding="utf-8") as f:
-        gj = json.load(f)
-    feats = gj.get("features", [])
-    # 出自ファイル名を properties に残す（デバッグやトレース用）
-    for ft in feats:
+# shapely の type_id → カテゴリ（-1 は NULL ジオメトリ）
+_CAT_BY_TYPE_ID = {
+    0: "points", 4: "points",      # Point / MultiPoint
+    1: "lines", 5: "lines",        # LineString / MultiLineString
+    3: "polygons", 6: "polygons",  # Polygon / MultiPolygon
+}
+
+def categorize_geoms(wkb):
+    """
+    WKB 配列をまとめて points / lines / polygons / others に分類（categorize_geom の配列版）
+    """
+    geoms = shapely.from_wkb(wkb)
+    ids = shapely.get_type_id(geoms)
+    cats = np.array([_CAT_BY_TYPE_ID.get(i, "others") for i in range(8)], dtype=object)[ids]
+    cats[ids < 0] = "others"
+    # GeometryCollection は構成要素で判定（単一カテゴリならそれ、混在は polygons）
+    for i in np.flatnonzero(ids == shapely.GeometryType.GEOMETRYCOLLECTION):
+        parts = {_CAT_BY_TYPE_ID.get(t) for t in shapely.get_type_id(shapely.get_parts(geoms[i]))}
+        parts.discard(None)
+        cats[i] = parts.pop() if len(parts) == 1 else "polygons"
+    return cats
+
+def find_inputs(root: Path):
+    """
+    *.3d.fgb / *.3d.gpkg / *.3d.geojson を再帰で集める。
+    同じ元ファイル由来で複数形式ある場合は更新日時が新しい方だけ採用
+    """
+    latest = {}
+    for sfx in INPUT_SUFFIXES:
+        for p in root.rglob("*" + sfx):
+            key = p.with_name(p.name[:-len(sfx)])
+            cur = latest.get(key)
+            if cur is None or p.stat().st_mtime > cur.stat().st_mtime:
+                latest[key] = p
+    return sorted(latest.values())
+
+def load_json(path: Path):
+    data = path.read_bytes()
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass  # NaN リテラル入りなどは標準 json で読む
+    return json.loads(data)
+
+def dump_json(obj) -> bytes:
+    """UTF-8 の JSON バイト列に変換（日付などは文字列化。orjson は NaN を null として書く）"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=str,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8")
+
+def _read_features(path: Path):
+    if path.suffix.lower() != ".geojson":
+        # FlatGeobuf / GPKG は GDAL 経由で読んで Feature dict に変換
+        import pyogrio
+        gdf = pyogrio.read_dataframe(path)
+        yield from gdf.iterfeatures(drop_id=True)
+        return
+    done = 0
+    if ijson is not None:
+        # 数値は Decimal ではなく float で受け取る（json.dump でそのまま書けるように）
+        try:
+            with path.open("rb") as f:
+                for ft in ijson.items(f, "features.item", use_float=True):
+                    done += 1
+                    yield ft
+            return
+        except ijson.JSONError:
+            # 旧版の出力は NaN リテラルを含むことがあり ijson では読めない → 続きを json で読む
+            pass
+    yield from load_json(path).get("features", [])[done:]
+
+def iter_features(path: Path):
+    """Feature を1つずつ返す（出自ファイル名を properties に残す：デバッグやトレース用）"""
+    for ft in _read_features(path):
         props = ft.get("properties") or {}
         props["__source_file"] = path.name
         ft["properties"] = props
-    return feats
+        yield ft
+
+def map_ordered(fn, items):
+    """
+    fn を READ_WORKERS 本のスレッドで並列に適用し、(item, 結果) を元の順序で返す。
+    一度に投入するのは READ_WORKERS 件までなので、全ファイルを同時にメモリへ抱え込まない
+    """
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as ex:
+        pending = deque()
+        for item in items:
+            pending.append((item, ex.submit(fn, item)))
+            if len(pending) >= READ_WORKERS:
+                done, fut = pending.popleft()
+                yield done, fut.result()
+        while pending:
+            done, fut = pending.popleft()
+            yield done, fut.result()
+
+def read_all(paths):
+    """複数ファイルをスレッドで並列に読み、(path, features) を元の順序で返す"""
+    if READ_WORKERS <= 1:
+        # 逐次なら Feature 単位のストリームのまま渡す
+        for p in paths:
+            yield p, iter_features(p)
+        return
+    yield from map_ordered(lambda p: list(iter_features(p)), paths)
+
+def _json_text(v):
+    """混在列の値を文字列に揃える（文字列はそのまま、数値・真偽値・入れ子は JSON 表記、null は null）"""
+    if v is None or isinstance(v, str):
+        return v
+    return dump_json(v).decode("utf-8")
+
+def _geojson_table(path: Path):
+    """
+    *.3d.geojson は JSON として読んで Arrow テーブルにする。
+    旧版の出力は NaN リテラルを含み、GDAL だと文字列混じりの列で "NaN" という文字列になってしまうため
+    （dict 版と同じく NaN は null として扱う）
+    """
+    feats = list(_read_features(path))
+    props = [ft.get("properties") or {} for ft in feats]
+    # 列は全 Feature のキーの和集合（初出順）。途中の Feature にしか無いキーも落とさない
+    keys = list(dict.fromkeys(k for pr in props for k in pr))
+    cols = {}
+    for k in keys:
+        vals = [pr.get(k) for pr in props]
+        vals = [None if isinstance(v, float) and v != v else v for v in vals]
+        if any(isinstance(v, (dict, list)) for v in vals):
+            cols[k] = pa.array([_json_text(v) for v in vals], pa.string())
+            continue
+        try:
+            cols[k] = pa.array(vals)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # この列だけ文字列と数値などが混在 → この列だけ JSON 表記の文字列に揃える
+            cols[k] = pa.array([_json_text(v) for v in vals], pa.string())
+    geoms = shapely.from_geojson([dump_json(ft["geometry"]) if ft.get("geometry") else None for ft in feats])
+    wkb = pa.array(shapely.to_wkb(geoms), pa.binary())
+    cols["geometry"] = wkb
+    return pa.table(cols)
+
+def read_table(path: Path):
+    """1ファイルを Arrow テーブルで読む（ジオメトリは WKB 列 'geometry'、出自ファイル名は __source_file 列）"""
+    if path.suffix.lower() == ".geojson":
+        tbl, crs = _geojson_table(path), None  # GeoJSON は WGS84 固定
+    else:
+        meta, tbl = pyogrio.read_arrow(path)
+        geom_col = meta["geometry_name"] or "wkb_geometry"
+        tbl = tbl.rename_columns(["geometry" if c == geom_col else c for c in tbl.column_names])
+        crs = meta["crs"]
+    return tbl.append_column("__source_file", pa.repeat(path.name, tbl.num_rows)), crs
+
+def read_all_tables(paths):
+    """複数ファイルをスレッドで並列に読み、(path, table, crs) を元の順序で返す"""
+    if READ_WORKERS <= 1:
+        for p in paths:
+            yield (p, *read_table(p))
+        return
+    for p, (tbl, crs) in map_ordered(read_table, paths):
+        yield p, tbl, crs
+
+def nan_to_null(tbl):
+    """浮動小数列の NaN を null にする（dict 版と同じく null で書き出し、文字列化で "NaN" にしない）"""
+    for i, f in enumerate(tbl.schema):
+        if pa.types.is_floating(f.type):
+            col = tbl.column(i)
+            tbl = tbl.set_column(i, f, pc.if_else(pc.is_nan(col), pa.scalar(None, f.type), col))
+    return tbl
+
+def concat_tables(tables):
+    """列構成の違うテーブルも結合（全部 null の列は落とし、型が食い違う列は文字列に揃える）"""
+    tables = [nan_to_null(t) for t in tables]
+    names = {f.name for t in tables for f in t.schema}
+    # バケツ内で一度も値が入らない列は出力しない（全 Feature に null を並べない）
+    empty = {n for n in names if n != "geometry"
+             and all(n not in t.column_names or t.column(n).null_count == t.num_rows for t in tables)}
+    tables = [t.drop_columns([n for n in t.column_names if n in empty]) for t in tables]
+    try:
+        return pa.concat_tables(tables, promote_options="permissive")
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        types = defaultdict(set)
+        for t in tables:
+            for f in t.schema:
+                if not pa.types.is_null(f.type):
+                    types[f.name].add(f.type)
+        bad = {name for name, ts in types.items() if len(ts) > 1 and name != "geometry"}
+        tables = [
+            t.cast(pa.schema([f.with_type(pa.string()) if f.name in bad else f for f in t.schema]))
+            for t in tables
+        ]
+        return pa.concat_tables(tables, promote_options="permissive")
+
+def write_table(path: Path, tbl, crs):
+    """Arrow テーブルを GeoJSON で一括書き出し（Feature ごとの dict 化・JSON 往復をしない）"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # 混在タイプでも Z を落とさないよう geometry_type は Unknown で渡す。
+    # WGS84 なら crs メンバは書かず（GeoJSON の既定）、name メンバも省いて dict 版の出力に揃える
+    if crs in ("EPSG:4326", "OGC:CRS84"):
+        crs = None
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="'crs' was not provided")
+        pyogrio.write_arrow(tbl, path, driver="GeoJSON",
+                            geometry_name="geometry", geometry_type="Unknown", crs=crs,
+                            layer_options={"WRITE_NAME": "NO"})
+    if GZIP_OUTPUT:
+        # 一旦素の GeoJSON で書いてから並列 gzip で圧縮し、元ファイルは消す
+        gz = path.with_suffix(path.suffix + ".gz")
+        write_gzip(gz, path.read_bytes())
+        path.unlink()
+        print(f"[OK] {gz.name}  ({tbl.num_rows} features)")
+    else:
+        print(f"[OK] {path.name}  ({tbl.num_rows} features)")
+
+def write_gzip(gz: Path, data: bytes):
+    """gzip で書き出す（pigz → mgzip → 標準 gzip の順に使えるものでマルチスレッド圧縮）"""
+    pigz = shutil.which("pigz") if GZIP_THREADS > 1 else None
+    if pigz:
+        with gz.open("wb") as f:
+            subprocess.run([pigz, "-p", str(GZIP_THREADS), "-c"], input=data, stdout=f, check=True)
+    elif mgzip is not None and GZIP_THREADS > 1:
+        with mgzip.open(str(gz), "wb", thread=GZIP_THREADS) as f:
+            f.write(data)
+    else:
+        with gzip.open(gz, "wb") as f:
+            f.write(data)
 
 def write_fc(path: Path, features):
     path.parent.mkdir(parents=True, exist_ok=True)
     fc = {"type": "FeatureCollection", "features": features}
     if GZIP_OUTPUT:
         gz = path.with_suffix(path.suffix + ".gz")
-        with gzip.open(gz, "wt", encoding="utf-8") as f:
-            json.dump(fc, f, ensure_ascii=False)
+        write_gzip(gz, dump_json(fc))
         print(f"[OK] {gz.name}  ({len(features)} features)")
     else:
-        with path.open("w", encoding="utf-8") as f:
-            json.dump(fc, f, ensure_ascii=False)
+        path.write_bytes(dump_json(fc))
         print(f"[OK] {path.name}  ({len(features)} features)")
 
+def main_arrow(files):
+    """Arrow 版: テーブルを (floor, cat) / (floor,) / (floor, kind) ごとに束ね、バケツ単位で結合して書く"""
+    targets = [p for p in files if infer_kind(p.name) in INCLUDE_KINDS]
+    buckets = defaultdict(list)  # key → list[Table]
+    crs = None
+    for p, tbl, tcrs in read_all_tables(targets):
+        crs = crs or tcrs
+        floor = infer_floor_label(p.name)
+        if MERGE_MODE == 'per_floor_by_geom':
+            cats = categorize_geoms(tbl.column("geometry").to_numpy(zero_copy_only=False))
+            for cat in ("polygons", "lines", "points", "others"):
+                mask = cats == cat
+                if mask.any():
+                    buckets[(floor, cat)].append(tbl.filter(pa.array(mask)))
+        elif MERGE_MODE == 'per_floor':
+            buckets[(floor,)].append(tbl)
+        else:  # per_floor_and_kind
+            buckets[(floor, infer_kind(p.name))].append(tbl)
+
+    for key, tables in buckets.items():
+        if MERGE_MODE == 'per_floor_by_geom':
+            outname = f"Tokyo_{key[0]}.{key[1]}.geojson"
+        elif MERGE_MODE == 'per_floor':
+            outname = f"Tokyo_{key[0]}.merged.3d.geojson"
+        else:
+            outname = f"Tokyo_{key[0]}_{key[1]}.merged.3d.geojson"
+        write_table(OUTPUT_DIR / outname, concat_tables(tables), crs)
+
 def main():
-    files = sorted(INPUT_DIR.rglob("*.3d.geojson"))  # 再帰探索
+    files = find_inputs(INPUT_DIR)  # 再帰探索
     if not files:
-        print(f"[ERR] {INPUT_DIR} に *.3d.geojson が見つかりません")
+        print(f"[ERR] {INPUT_DIR} に *.3d.fgb / *.3d.gpkg / *.3d.geojson が見つかりません")
         sys.exit(1)
 
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
@@ -132,15 +416,16 @@ def main():
         print(f"[ERR] MERGE_MODE '{MERGE_MODE}' は不正です")
         sys.exit(2)
 
+    if pa is not None:
+        main_arrow(files)
+        return
+
     if MERGE_MODE == 'per_floor_by_geom':
         # floor → {points:[], lines:[], polygons:[], others:[]}
         buckets = defaultdict(lambda: defaultdict(list))
-        for p in files:
+        targets = [p for p in files if infer_kind(p.name) in INCLUDE_KINDS]
+        for p, feats in read_all(targets):
             floor = infer_floor_label(p.name)
-            kind  = infer_kind(p.name)
-            if kind not in INCLUDE_KINDS:
-                continue
-            feats = load_features(p)
             for ft in feats:
                 cat = categorize_geom(ft)
                 buckets[floor][cat].append(ft)
@@ -177,8 +462,8 @@ def main():
             outname = f"Tokyo_{floor}_{kind}.merged.3d.geojson"
 
         features = []
-        for p in paths:
-            features.extend(load_features(p))
+        for _, feats in read_all(paths):
+            features.extend(feats)
         write_fc(OUTPUT_DIR / outname, features)
 
 if __name__ == "__main__":
@@ -4,10 +4,18 @@
 GeoJSON の全座標に Z=BASE_Z を付与（または欠損時のみ付与）
 - MultiPolygon/Polygon/MultiLineString/… すべて対応
 - FeatureCollection / Feature / GeometryCollection もOK
+- properties / id / crs などは JSON のまま残し、座標だけ (N,3) の配列にまとめて一括更新（shapely>=2）
 """
 
 import json
 from pathlib import Path
+import shapely
+
+# orjson があれば JSON の読み書きを C 実装で高速化（なければ標準 json）
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None
 
 # ===== 設定（ここだけ編集）=========================================
 IN_FILE  = Path("r3_tokyo_tochiriyo.geojson")      # 入力ファイル
@@ -17,66 +25,92 @@ BASE_Z   = 3.2     # 付与する標高[m]
 FILL_ONLY = False   # False: 既存Zも上書き / True: Zが無い点だけ付与
 # ================================================================
 
-def with_z(coord):
-    """coord が [x,y] or [x,y,z,...] のいずれでも Z を調整して返す"""
-    if not isinstance(coord, list) or len(coord) < 2:
-        return coord
-    x, y = coord[0], coord[1]
+def with_z(geoms):
+    """ジオメトリ配列に Z を付与して返す（2D/3D 混在でも可）"""
+    # Zが無いジオメトリ → BASE_Z で3D化（既存Zはそのまま）
+    had_z = shapely.has_z(geoms)
+    geoms = shapely.force_3d(geoms, BASE_Z)
+    if FILL_ONLY or not had_z.any():
+        return geoms  # 既存Zを尊重 / 元から全部2Dなら force_3d だけで完了
+    # 元から Z を持つものだけ全頂点の Z を上書き
+    sub = geoms[had_z]
+    coords = shapely.get_coordinates(sub, include_z=True)
+    coords[:, 2] = BASE_Z
+    geoms[had_z] = shapely.set_coordinates(sub, coords)
+    return geoms
+
+def with_z_coord(coord):
+    """coord が [x,y] or [x,y,z,...] のいずれでも Z を調整して返す（GEOS で読めない形状用）"""
     if len(coord) >= 3:
         if FILL_ONLY:
             return coord  # 既存Zを尊重
-        else:
-            out = coord[:]  # 上書き
-            out[2] = BASE_Z
-            return out
-    else:
-        # Zが無い → 追加
-        return [x, y, BASE_Z]
+        return [coord[0], coord[1], BASE_Z, *coord[3:]]
+    return [coord[0], coord[1], BASE_Z]
 
 def walk_coords(obj):
     """coordinates 配列の任意次元リストを再帰で処理"""
     if isinstance(obj, list):
-        # coord (数値配列) か、入れ子配列かを判定
         if len(obj) >= 2 and all(isinstance(c, (int, float)) for c in obj[:2]):
-            return with_z(obj)
-        else:
-            return [walk_coords(e) for e in obj]
+            return with_z_coord(obj)
+        return [walk_coords(e) for e in obj]
     return obj
 
-def process_geom(geom):
-    if not isinstance(geom, dict) or "type" not in geom:
-        return geom
-    gtype = geom["type"]
-    if gtype == "GeometryCollection":
-        geoms = geom.get("geometries", [])
-        geom["geometries"] = [process_geom(g) for g in geoms]
-        return geom
-    if "coordinates" in geom:
+def walk_geom(geom):
+    """geometry dict を1つずつ処理（閉じていないリングや4次元座標など、GEOS が読めないもの向け）"""
+    if geom.get("type") == "GeometryCollection":
+        geom["geometries"] = [walk_geom(g) for g in geom.get("geometries", []) if isinstance(g, dict)]
+    elif "coordinates" in geom:
         geom["coordinates"] = walk_coords(geom["coordinates"])
     return geom
 
-def process(obj):
+def load_json(path: Path):
+    data = path.read_bytes()
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass  # NaN リテラル入りなどは標準 json で読む
+    return json.loads(data)
+
+def dump_json(obj) -> bytes:
+    """UTF-8 の JSON バイト列に変換（日付などは文字列化）"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8")
+
+def geometry_slots(obj):
+    """geometry dict の置き場所を (入れ物, キー) のリストで返す"""
     if not isinstance(obj, dict) or "type" not in obj:
-        return obj
+        return []
     otype = obj["type"]
     if otype == "FeatureCollection":
-        feats = obj.get("features", [])
-        for ft in feats:
-            if isinstance(ft, dict) and "geometry" in ft:
-                ft["geometry"] = process_geom(ft["geometry"])
-        return obj
-    elif otype == "Feature":
-        if "geometry" in obj:
-            obj["geometry"] = process_geom(obj["geometry"])
-        return obj
-    else:
-        # Geometry 単体
-        return process_geom(obj)
+        return [(ft, "geometry") for ft in obj.get("features", [])
+                if isinstance(ft, dict) and isinstance(ft.get("geometry"), dict)]
+    if otype == "Feature":
+        return [(obj, "geometry")] if isinstance(obj.get("geometry"), dict) else []
+    return []
 
 def main():
-    data = json.loads(IN_FILE.read_text(encoding="utf-8"))
-    data = process(data)
-    OUT_FILE.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    data = load_json(IN_FILE)
+    # Geometry 単体のときは Feature 風の入れ物に包んで同じ手順で処理する
+    bare = isinstance(data, dict) and data.get("type") not in (None, "FeatureCollection", "Feature")
+    if bare:
+        data = {"type": "Feature", "geometry": data}
+
+    slots = geometry_slots(data)
+    if slots:
+        # geometry だけを GEOS に渡し、座標をまとめて更新して dict に戻す（properties 等は触らない）
+        geoms = shapely.from_geojson([dump_json(c[k]) for c, k in slots], on_invalid="ignore")
+        ok = ~shapely.is_missing(geoms)
+        out = shapely.to_geojson(with_z(geoms[ok]))
+        loads = orjson.loads if orjson is not None else json.loads
+        done = iter(out)
+        for (c, k), m in zip(slots, ok):
+            c[k] = loads(next(done)) if m else walk_geom(c[k])
+
+    if bare:
+        data = data["geometry"]
+    OUT_FILE.write_bytes(dump_json(data))
     print(f"[OK] Wrote {OUT_FILE} with Z={BASE_Z} (FILL_ONLY={FILL_ONLY})")
 
 if __name__ == "__main__":
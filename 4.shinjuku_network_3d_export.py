@@ -7,14 +7,19 @@
 - BASE_Z + FLOOR_OFFSETS でノードZを計算
 - リンクの start_id / end_id でノードZを対応付け、始点・終点のZを設定
 - リンク形状は始点Z〜終点Zを線形補間して3D化
-- 出力: ./Shinjuku_link_3d.geojson
+- 出力: ./Shinjuku_link_3d.geojson（OUT_DRIVER で FlatGeobuf / GPKG も選択可）
 """
 
+import importlib.util
+from functools import lru_cache
 from pathlib import Path
-import math
-import geopandas as gpd
-from shapely.geometry import LineString, MultiLineString
-from pyproj import CRS
+import numpy as np
+import pyogrio
+import shapely
+from pyproj import CRS, Transformer
+
+# pyarrow があれば Arrow 経由で読み込む（属性を列単位でまとめて変換）
+USE_ARROW = importlib.util.find_spec("pyarrow") is not None
 
 # ====== 設定（必要に応じて変更） =========================================
 DATA_DIR = Path("./shape/nw")
@@ -22,12 +27,21 @@ NODE_SHP = DATA_DIR / "Tokyo_node.shp"
 LINK_SHP = DATA_DIR / "Tokyo_Link.shp"
 OUT_GEOJSON = Path("./tokyo_link_3d.geojson")
 
+# 出力形式: 'GeoJSON'（index.html から直接読むため既定） / 'FlatGeobuf' / 'GPKG'
+# GeoJSON 以外は OUT_GEOJSON の拡張子を差し替えて書き出す
+OUT_DRIVER = "GeoJSON"
+OUT_SUFFIXES = {"FlatGeobuf": ".fgb", "GPKG": ".gpkg", "GeoJSON": ".geojson"}
+
 # 列名（データ定義書に合わせて変更可能）
 NODE_ID_COL = "node_id"
 NODE_LVL_COL = "ordinal"      # 階層数（数値）
 LINK_S_COL   = "start_id"
 LINK_E_COL   = "end_id"
 
+# リンクから読み込む属性列（None なら全列を読み、そのまま出力にも残す）
+#   例: LINK_READ_COLS = [LINK_S_COL, LINK_E_COL]
+LINK_READ_COLS = None
+
 # Z = BASE_Z + FLOOR_OFFSETS[floor_label]
 BASE_Z = 3.2  # 新宿駅の基準標高 (m, AMSL)
 
@@ -44,6 +58,26 @@ FLOOR_OFFSETS = {
 
 # ====== 関数定義 ===========================================================
 
+WGS84 = CRS.from_epsg(4326)
+
+@lru_cache(maxsize=8)
+def _transformer_to_wgs84(src_wkt: str) -> Transformer:
+    """入力CRSごとに1度だけ Transformer を作って使い回す"""
+    return Transformer.from_crs(CRS.from_wkt(src_wkt), WGS84, always_xy=True)
+
+def to_wgs84(gdf):
+    """
+    WGS84(EPSG:4326) へ再投影。既に WGS84 / CRS 無しなら何もしない。
+    ジオメトリを作り直さず、座標配列をまとめて変換して書き戻す
+    """
+    if not gdf.crs or gdf.crs == WGS84:
+        return gdf
+    t = _transformer_to_wgs84(gdf.crs.to_wkt())
+    geoms = np.array(gdf.geometry.values, dtype=object)
+    xyz = shapely.get_coordinates(geoms, include_z=True)
+    xyz[:, 0], xyz[:, 1] = t.transform(xyz[:, 0], xyz[:, 1])
+    return gdf.set_geometry(shapely.set_coordinates(geoms, xyz), crs=WGS84)
+
 def ord_to_floor(o):
     """ordinal(float/int) → 階ラベル（例：-2→2B, 0→0F, 2→2F）"""
     if o is None:
@@ -67,73 +101,84 @@ def floor_to_z(floor_label: str) -> float | None:
     return None if off is None else BASE_Z + off
 
 # ---- 2D距離に沿ってZを線形内挿（端点は指定Zに一致） ----------------------
-def _interp_line(line: LineString, z0: float, z1: float) -> LineString:
-    xy = list(line.coords)
-    if len(xy) == 1:
-        x, y = xy[0]
-        return LineString([(x, y, z0)])
-    # 各セグメント長
-    seg = [math.hypot(xy[i+1][0]-xy[i][0], xy[i+1][1]-xy[i][1]) for i in range(len(xy)-1)]
-    total = sum(seg) or 1e-9
-    acc = 0.0
-    coords = [(xy[0][0], xy[0][1], z0)]
-    for i in range(1, len(xy)):
-        acc += seg[i-1]
-        t = acc / total
-        z = z0 + (z1 - z0) * t
-        coords.append((xy[i][0], xy[i][1], z))
-    return LineString(coords)
-
-def add_z_geometry(geom, z0: float, z1: float):
-    if isinstance(geom, LineString):
-        return _interp_line(geom, z0, z1)
-    elif isinstance(geom, MultiLineString):
-        return MultiLineString([_interp_line(g, z0, z1) for g in geom.geoms])
-    else:
-        return geom  # 想定外はそのまま
+LINE_TYPES = [shapely.GeometryType.LINESTRING, shapely.GeometryType.MULTILINESTRING]
+
+def add_z_lines(geoms, z0: np.ndarray, z1: np.ndarray) -> np.ndarray:
+    """
+    ライン配列全体に Z を付与して返す（z0/z1 はジオメトリごとの始点・終点Z）。
+    MultiLineString はパートごとに z0〜z1 を内挿。ライン以外はそのまま
+    """
+    geoms = np.array(geoms, dtype=object)
+    is_line = np.isin(shapely.get_type_id(geoms), LINE_TYPES)
+    lines = geoms[is_line]
+    z0, z1 = z0[is_line], z1[is_line]
+
+    # 全パートの座標を1本の配列にまとめる（pidx: 各座標が属するパート番号）
+    parts, gidx = shapely.get_parts(lines, return_index=True)
+    xy, pidx = shapely.get_coordinates(parts, return_index=True)
+
+    # 各座標の直前セグメント長（パート先頭は0）
+    head = np.ones(len(xy), dtype=bool)
+    head[1:] = pidx[1:] != pidx[:-1]
+    seg = np.zeros(len(xy))
+    seg[1:] = np.hypot(np.diff(xy[:, 0]), np.diff(xy[:, 1]))
+    seg[head] = 0.0
+
+    # パート内の累積距離（先頭座標の累積値を引く）と総延長
+    acc = np.cumsum(seg)
+    acc -= acc[head][np.cumsum(head) - 1]
+    total = np.bincount(pidx, weights=seg, minlength=len(parts))
+    total[total == 0.0] = 1e-9
+
+    # 座標ごとの z0/z1 に展開して線形内挿
+    zs, ze = z0[gidx][pidx], z1[gidx][pidx]
+    z = zs + (ze - zs) * (acc / total[pidx])
+
+    geoms[is_line] = shapely.set_coordinates(shapely.force_3d(lines), np.column_stack([xy, z]))
+    return geoms
 
 # ====== データ読込 =========================================================
 print("[INFO] ノード・リンクデータを読込中...")
-nodes = gpd.read_file(NODE_SHP)
-links = gpd.read_file(LINK_SHP)
+# ノードは ID と階層数しか使わないので、その2列だけ読む（形状も不要なので読まない＝再投影も不要）
+nodes = pyogrio.read_dataframe(NODE_SHP, columns=[NODE_ID_COL, NODE_LVL_COL],
+                               read_geometry=False, use_arrow=USE_ARROW)
+links = pyogrio.read_dataframe(LINK_SHP, columns=LINK_READ_COLS, use_arrow=USE_ARROW)
 
 # CRSをWGS84(EPSG:4326)に統一
-if nodes.crs and CRS.from_user_input(nodes.crs) != CRS.from_epsg(4326):
-    nodes = nodes.to_crs(4326)
-if links.crs and CRS.from_user_input(links.crs) != CRS.from_epsg(4326):
-    links = links.to_crs(4326)
+links = to_wgs84(links)
 
 # ====== ノードに階層ラベルとZを付与 ========================================
 nodes["floor_label"] = nodes[NODE_LVL_COL].apply(ord_to_floor)
 nodes["z"] = nodes["floor_label"].apply(floor_to_z)
 
 # ====== リンクに始点・終点Zを結合 ==========================================
-L = links.merge(
-        nodes[[NODE_ID_COL, "floor_label", "z"]]
-            .rename(columns={NODE_ID_COL: LINK_S_COL, "floor_label": "floor_s", "z": "z_start"}),
-        on=LINK_S_COL, how="left"
-    ).merge(
-        nodes[[NODE_ID_COL, "floor_label", "z"]]
-            .rename(columns={NODE_ID_COL: LINK_E_COL, "floor_label": "floor_e", "z": "z_end"}),
-        on=LINK_E_COL, how="left"
-    )
-
-# 欠損チェック
-missing = L[L[["z_start", "z_end"]].isna().any(axis=1)]
-if len(missing):
-    print(f"[WARN] Z欠損のリンク: {len(missing)} 本（対応ノード不明）")
-L = L.dropna(subset=["z_start", "z_end"]).copy()
+# merge（結合）ではなく、ノードID → 階ラベル / Z の辞書で引く
+floor_map = dict(zip(nodes[NODE_ID_COL], nodes["floor_label"]))
+z_map = dict(zip(nodes[NODE_ID_COL], nodes["z"]))
+L = links
+L["floor_s"] = L[LINK_S_COL].map(floor_map)
+L["z_start"] = L[LINK_S_COL].map(z_map).astype(float)
+L["floor_e"] = L[LINK_E_COL].map(floor_map)
+L["z_end"] = L[LINK_E_COL].map(z_map).astype(float)
+
+# 欠損チェック（マスクは1回だけ作る）
+ok = L["z_start"].notna().to_numpy() & L["z_end"].notna().to_numpy()
+if not ok.all():
+    print(f"[WARN] Z欠損のリンク: {(~ok).sum()} 本（対応ノード不明）")
+    L = L.loc[ok].copy()
 
 # ====== 3D形状を生成 =======================================================
 print("[INFO] リンク形状にZ値を付与中...")
-L["geometry"] = L.apply(
-    lambda r: add_z_geometry(r.geometry, float(r["z_start"]), float(r["z_end"])),
-    axis=1
+L["geometry"] = add_z_lines(
+    L.geometry.values,
+    L["z_start"].to_numpy(dtype=float),
+    L["z_end"].to_numpy(dtype=float),
 )
 L = L.set_geometry("geometry", crs="EPSG:4326")
 
-# ====== GeoJSON出力 ========================================================
-print("[INFO] GeoJSONを書き出し中...")
-L.to_file(OUT_GEOJSON, driver="GeoJSON", encoding="utf-8")
+# ====== 出力 ===============================================================
+out_path = OUT_GEOJSON.with_suffix(OUT_SUFFIXES[OUT_DRIVER])
+print(f"[INFO] {OUT_DRIVER}を書き出し中...")
+L.to_file(out_path, driver=OUT_DRIVER, engine="pyogrio", encoding="utf-8")
 
-print(f"[DONE] 出力完了: {OUT_GEOJSON.resolve()}")
+print(f"[DONE] 出力完了: {out_path.resolve()}")